@@ -2,15 +2,30 @@
 # pylint: disable=missing-module-docstring,missing-class-docstring,missing-function-docstring
 
 from argparse import ArgumentParser, Namespace
-from dataclasses import dataclass
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from functools import cached_property
-import json
+from operator import itemgetter
 import datetime
+import os
 from pathlib import Path
 import subprocess
-from typing import Any
+from typing import IO, Any, Iterator
 from urllib.parse import quote
 
+import ijson
+
+LIST_FOLDER_WORKERS = 32
+DUPLICATE_TEMPLATE = "- {name}  \n\tGröße: {size}  \n\tAndere(r) Ordner:  \n\t- {others}  "
+SIZE_SUFFIXES: tuple[str, ...] = ('B', 'KB', 'MB', 'GB', 'TB', 'PB')
+
+# Equal parent folders share one Path object, many duplicates live in the same folders
+_INTERNED_PATHS: dict[Path, Path] = {}
+
+def _intern_path(path: Path) -> Path:
+    return _INTERNED_PATHS.setdefault(path, path)
+
 class Log:
     @staticmethod
     def info(message: str):
@@ -20,6 +35,7 @@ class Log:
 class NextcloudInfo:
     domain: str
     user: str
+    _quote_cache: dict[Path, str] = field(default_factory=dict, init=False, repr=False, compare=False)
 
     @property
     def user_file_path(self) -> Path :
@@ -29,22 +45,35 @@ class NextcloudInfo:
     def base_file_url(self) -> str:
         return f"{self.domain}/apps/files/?dir=/"
 
-    def create_link(self, path: Path, is_folder: bool = False) -> str:
+    def create_folder_link(self, path: Path) -> str:
+        return self._create_folder_link(self._relative_to_user_files(path))
+
+    def create_file_link(self, path: Path) -> str:
+        return self.create_relative_file_link(self._relative_to_user_files(path))
+
+    def create_relative_file_link(self, relative_path: Path) -> str:
+        return self._create_folder_link(relative_path.parent) + "/" + relative_path.name
+
+    def _relative_to_user_files(self, path: Path) -> Path:
         if (path.is_relative_to(self.user_file_path)):
-            path = path.relative_to(self.user_file_path)
-        if is_folder:
-            return self._create_folder_link(path)
-        parent_link = self._create_folder_link(path.parent)
-        return parent_link + "/" + path.name
+            return path.relative_to(self.user_file_path)
+        return path
 
     def _create_folder_link(self, path:Path) -> str:
-        return f"[{path}]({self.base_file_url}{quote(str(path))})"
+        quoted_path = self._quote_cache.get(path)
+        if quoted_path is None:
+            quoted_path = self._quote_cache[path] = quote(str(path))
+        return f"[{path}]({self.base_file_url}{quoted_path})"
 
 
 class MatchSet:
+    __slots__ = ("_file_size", "_file_list", "_directory_list", "_file_set")
+
     def __init__(self, json_data: dict[str, Any]) -> None:
         self._file_size: int = json_data["fileSize"]
         self._file_list: list[Path] = self._get_file_list(json_data)
+        self._directory_list: list[Path] = [_intern_path(x.parent) for x in self._file_list]
+        self._file_set: frozenset[Path] | None = None
 
     @staticmethod
     def _get_file_list(json_data: dict[str, Any]) -> list[Path]:
@@ -61,11 +90,17 @@ class MatchSet:
     def file_list(self) -> list[Path]:
         return self._file_list
 
-    @cached_property
+    @property
     def directory_list(self) -> list[Path]:
-        return [x.parent for x in self._file_list]
+        return self._directory_list
 
-@dataclass(frozen=True)
+    @property
+    def file_set(self) -> frozenset[Path]:
+        if self._file_set is None:
+            self._file_set = frozenset(self._file_list)
+        return self._file_set
+
+@dataclass(frozen=True, slots=True)
 class DuplicateInFolder:
     in_duplicate_folder: Path
     other_paths: frozenset[Path]
@@ -75,44 +110,79 @@ class JDupesOutput:
 
     def __init__(self, nextcloud_info: NextcloudInfo, min_file_size: int = 0) -> None:
         self._nextcloud_info = nextcloud_info
-        json_data = self._execute_jdupes(nextcloud_info)
-        self.version: str = json_data["jdupesVersion"]
-        version_date_str: str = json_data["jdupesVersionDate"]
+        header, match_sets = self._execute_jdupes(nextcloud_info, min_file_size)
+        self.version: str = header["jdupesVersion"]
+        version_date_str: str = header["jdupesVersionDate"]
         self.version_date: datetime.date = datetime.date.fromisoformat(version_date_str)
-        self.command_line: str = json_data["commandLine"]
-        self.extension_flags: str = json_data["extensionFlags"]
-        self.match_sets: set[MatchSet] = self._get_matchsets(json_data, min_file_size)
-        self._folder_cache: dict[Path, set[MatchSet]] = self._create_folder_cache(self.match_sets)
+        self.command_line: str = header["commandLine"]
+        self.extension_flags: str = header["extensionFlags"]
+        self.match_sets: list[MatchSet] = match_sets
+        self._folder_index: dict[Path, list[tuple[Path, MatchSet]]] = self._create_folder_cache(
+            self.match_sets)
+        self._duplicates_in_folder_cache: dict[Path, tuple[DuplicateInFolder, ...]] = {}
+        self._relative_paths: dict[Path, Path] = self._create_relative_paths(
+            self.match_sets, nextcloud_info.user_file_path)
 
     @staticmethod
-    def _execute_jdupes(nextcloud_info: NextcloudInfo) -> dict[str, Any]:
-        args = f"jdupes -j -r {nextcloud_info.user_file_path}"
-        Log.info(f"Starting JDupes with arguments: {args}")
-        json_str: str = subprocess.run(
-            ["jdupes" ,"-j", "-r", nextcloud_info.user_file_path ],
-            stdout=subprocess.PIPE,
-            check=True).stdout.decode('utf-8')
+    def _execute_jdupes(nextcloud_info: NextcloudInfo,
+            min_file_size: int) -> tuple[dict[str, Any], list[MatchSet]]:
+        args = ["jdupes" ,"-j", "-r", str(nextcloud_info.user_file_path)]
+        Log.info(f"Starting JDupes with arguments: {' '.join(args)}")
+        with subprocess.Popen(args, stdout=subprocess.PIPE) as process:
+            assert process.stdout is not None
+            try:
+                header, match_sets = JDupesOutput._read_jdupes_output(process.stdout, min_file_size)
+            except ijson.JSONError as error:
+                if process.wait() != 0:
+                    raise subprocess.CalledProcessError(process.returncode, args) from error
+                raise
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, args)
         Log.info("Executed JDupes")
-        return json.loads(json_str)
+        return header, match_sets
 
     @staticmethod
-    def _get_matchsets(json_data: dict[str, Any], min_file_size: int) -> set[MatchSet]:
-        result:set[MatchSet] = set()
-        for match_set in json_data["matchSets"]:
-            match_set_obj = MatchSet(match_set)
-            if match_set_obj.file_size > min_file_size:
-                result.add(match_set_obj)
-        return result
+    def _read_jdupes_output(stream: IO[bytes],
+            min_file_size: int) -> tuple[dict[str, Any], list[MatchSet]]:
+        header: dict[str, Any] = {}
+        match_sets: list[MatchSet] = []
+        for key, value in JDupesOutput._parse_jdupes_output(stream):
+            if key == "matchSets":
+                match_set = MatchSet(value)
+                if match_set.file_size > min_file_size:
+                    match_sets.append(match_set)
+            else:
+                header[key] = value
+        return header, match_sets
 
     @staticmethod
-    def _create_folder_cache(match_sets: set[MatchSet]) -> dict[Path, set[MatchSet]]:
-        result: dict[Path, set[MatchSet]] = {}
+    def _parse_jdupes_output(stream: IO[bytes]) -> Iterator[tuple[str, Any]]:
+        # Yields the top level values and every match set as ("matchSets", match_set) while jdupes runs
+        builder: ijson.ObjectBuilder | None = None
+        for prefix, event, value in ijson.parse(stream):
+            if builder is not None:
+                builder.event(event, value)
+                if prefix == "matchSets.item" and event == "end_map":
+                    yield "matchSets", builder.value
+                    builder = None
+            elif prefix == "matchSets.item" and event == "start_map":
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+            elif "." not in prefix and event in ("string", "number", "boolean", "null"):
+                yield prefix, value
+
+    @staticmethod
+    def _create_folder_cache(match_sets: list[MatchSet]) -> dict[Path, list[tuple[Path, MatchSet]]]:
+        result: defaultdict[Path, list[tuple[Path, MatchSet]]] = defaultdict(list)
         for match_set in match_sets:
-            for folder in match_set.directory_list:
-                if folder not in result:
-                    result[folder] = set()
-                result[folder].add(match_set)
-        return result
+            for file_path, folder in zip(match_set.file_list, match_set.directory_list):
+                result[folder].append((file_path, match_set))
+        return dict(result)
+
+    @staticmethod
+    def _create_relative_paths(match_sets: list[MatchSet], base_path: Path) -> dict[Path, Path]:
+        return {file_path: file_path.relative_to(base_path)
+            for match_set in match_sets for file_path in match_set.file_list}
 
     @cached_property
     def total_size(self) -> int:
@@ -122,78 +192,87 @@ class JDupesOutput:
     def folders_with_duplicates(self) -> set[Path]:
         result: set[Path] = set()
         for match_set in self.match_sets:
-            for file_path in match_set.file_list:
-                result.add(file_path.parent)
+            result.update(match_set.directory_list)
         return result
 
-    def duplicates_in_folder(self, folder: Path) -> list[DuplicateInFolder]:
+    def duplicates_in_folder(self, folder: Path) -> tuple[DuplicateInFolder, ...]:
+        cached = self._duplicates_in_folder_cache.get(folder)
+        if cached is not None:
+            return cached
         result: list[DuplicateInFolder] = []
-        for match_set in self._folder_cache[folder]:
-            for file_path in match_set.file_list:
-                if file_path.parent == folder:
-                    other_files: set[Path] = set(match_set.file_list.copy())
-                    other_files.remove(file_path)
-                    other_files_frozen = frozenset(other_files)
-                    result.append(DuplicateInFolder(file_path,other_files_frozen,match_set.file_size))
+        for file_path, match_set in self._folder_index[folder]:
+            other_files: frozenset[Path] = match_set.file_set - {file_path}
+            result.append(DuplicateInFolder(file_path, other_files, match_set.file_size))
         result.sort(key=lambda duplicate_in_folder: duplicate_in_folder.in_duplicate_folder)
-        return result
+        frozen_result = tuple(result)
+        self._duplicates_in_folder_cache[folder] = frozen_result
+        return frozen_result
+
 
+    @staticmethod
+    def _list_folders(folders: set[Path]) -> dict[Path, list[str]]:
+        folder_list = list(folders)
+        with ThreadPoolExecutor(max_workers=LIST_FOLDER_WORKERS) as executor:
+            contents = executor.map(JDupesOutput._list_folder, folder_list)
+            return dict(zip(folder_list, contents))
+
+    @staticmethod
+    def _list_folder(folder: Path) -> list[str]:
+        with os.scandir(folder) as entries:
+            return [entry.name for entry in entries]
 
     def to_markdown(self)-> str:
         Log.info("Parse Folders with duplicates")
-        duplicate_folders: list[tuple[Path, list[DuplicateInFolder], list[Path]]] = []
+        duplicate_folders: list[tuple[Path, tuple[DuplicateInFolder, ...], list[Path], int]] = []
+        folder_contents = self._list_folders(self.folders_with_duplicates)
         for duplicate_folder in self.folders_with_duplicates:
-            all_files: list[Path] =  list(duplicate_folder.iterdir())
-            duplicates_in_folder: list[DuplicateInFolder] = self.duplicates_in_folder(duplicate_folder)
-            duplicate_files: set[Path] = set()
-            for duplicate_match_set in duplicates_in_folder:
-                duplicate_files.add(duplicate_match_set.in_duplicate_folder)
-            not_duplicate_files: list[Path] = [x for x in all_files if x not in duplicate_files]
-            duplicate_folders.append((duplicate_folder,duplicates_in_folder, not_duplicate_files))
+            all_file_names: list[str] = folder_contents[duplicate_folder]
+            duplicates_in_folder: tuple[DuplicateInFolder, ...] = self.duplicates_in_folder(
+                duplicate_folder)
+            duplicate_file_names: set[str] = {
+                duplicate_match_set.in_duplicate_folder.name for duplicate_match_set in duplicates_in_folder}
+            not_duplicate_files: list[Path] = [duplicate_folder / name for name in all_file_names
+                if name not in duplicate_file_names]
+            duplicate_folders.append((duplicate_folder, duplicates_in_folder, not_duplicate_files,
+                len(not_duplicate_files)))
         Log.info("Create Markdown output")
-        duplicate_folders=  sorted(duplicate_folders, key= lambda x: len(x[2]))
-        result: list[str] = []
-        result.append(f"# Duplikate von {self._nextcloud_info.user}")
-        result.append(
-            f"Es gibt {len(self.match_sets)} Duplikate in {len(self.folders_with_duplicates)} Ordnern.  ")
-        result.append(f"Diese sind insgesamt {humansize(self.total_size)} groß.")
-        result.append("## Alle Ordner mit Duplikaten")
-        
-        for entry in duplicate_folders:
-            duplicate_folder = entry[0]
-            duplicates_in_folder = entry[1]
-            not_duplicate_files = entry[2]
-            folder_link = self._nextcloud_info.create_link(
-                duplicate_folder, is_folder=True)
-            result.append(f"## Ordner mit Duplikaten: {folder_link}")
-            duplicate_folder_size= humansize(sum(map(lambda x: x.size,
-                self.duplicates_in_folder(duplicate_folder))))
-            result.append(f"Die Duplikate in diesem Ordner sind { duplicate_folder_size} groß  ")
+        duplicate_folders=  sorted(duplicate_folders, key=itemgetter(3))
+        return "\n".join(self._markdown_lines(duplicate_folders))
+
+    def _markdown_lines(self,
+            duplicate_folders: list[tuple[Path, tuple[DuplicateInFolder, ...], list[Path], int]]
+            ) -> Iterator[str]:
+        yield f"# Duplikate von {self._nextcloud_info.user}"
+        yield f"Es gibt {len(self.match_sets)} Duplikate in {len(self.folders_with_duplicates)} Ordnern.  "
+        yield f"Diese sind insgesamt {humansize(self.total_size)} groß."
+        yield "## Alle Ordner mit Duplikaten"
+
+        file_links: dict[Path, str] = {
+            file_path: self._nextcloud_info.create_relative_file_link(relative_path)
+            for file_path, relative_path in self._relative_paths.items()}
+        for duplicate_folder, duplicates_in_folder, not_duplicate_files, _ in duplicate_folders:
+            folder_link = self._nextcloud_info.create_folder_link(duplicate_folder)
+            yield f"## Ordner mit Duplikaten: {folder_link}"
+            duplicate_folder_size= humansize(sum(map(lambda x: x.size, duplicates_in_folder)))
+            yield f"Die Duplikate in diesem Ordner sind { duplicate_folder_size} groß  "
             if len(not_duplicate_files) == 0:
-                result.append("Dieser Ordner enthält nur Duplikate  ")
+                yield "Dieser Ordner enthält nur Duplikate  "
 
-            result.append("### Duplizierte Dateien:")
+            yield "### Duplizierte Dateien:"
             for duplicate_match_set in duplicates_in_folder:
-                result.append(f"- {duplicate_match_set.in_duplicate_folder.relative_to(self._nextcloud_info.user_file_path)}  ")
-                result.append(f"\tGröße: {humansize(duplicate_match_set.size)}  ")
-                duplicate_files_str ="\t- "+"  \n\t- ".join(
-                    [self._nextcloud_info.create_link(x) for x in duplicate_match_set.other_paths])
-                result.append("\tAndere(r) Ordner:  ")
-                result.append(f"{duplicate_files_str}  ")
+                yield DUPLICATE_TEMPLATE.format(
+                    name=self._relative_paths[duplicate_match_set.in_duplicate_folder],
+                    size=humansize(duplicate_match_set.size),
+                    others="  \n\t- ".join(file_links[x] for x in duplicate_match_set.other_paths))
             if len(not_duplicate_files) > 0:
-                result.append("### Nicht duplizierte Dateien")
+                yield "### Nicht duplizierte Dateien"
                 for not_duplicate_file in not_duplicate_files:
-                    result.append(f"- {not_duplicate_file.relative_to(self._nextcloud_info.user_file_path)}")
-        return "\n".join(result)
-
-def humansize(nbytes: float) -> str:
-    suffixes: list[str] = ['B', 'KB', 'MB', 'GB', 'TB', 'PB']
-    i = 0
-    while nbytes >= 1024 and i < len(suffixes)-1:
-        nbytes /= 1024.
-        i += 1
-    size = (f'{nbytes:.2f}').rstrip('0').rstrip('.')
-    return f'{size}  {suffixes[i]}'
+                    yield f"- {not_duplicate_file.relative_to(self._nextcloud_info.user_file_path)}"
+
+def humansize(nbytes: int) -> str:
+    i = min(max(0, (int(nbytes).bit_length() - 1) // 10), len(SIZE_SUFFIXES) - 1)
+    size = (f'{nbytes / (1 << (10 * i)):.2f}').rstrip('0').rstrip('.')
+    return f'{size}  {SIZE_SUFFIXES[i]}'
 
 def parse_args() -> Namespace:
     parser = ArgumentParser()